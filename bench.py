@@ -0,0 +1,179 @@
+#!/usr/bin/env python3.6
+
+
+from cmd import Cmd
+from fix import Fixer, ErrorsFixed
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from math import log2
+from os import path, makedirs
+import argparse
+import struct
+import random
+import json
+import os
+
+ops = ("import", "ls", "cat", "hd", "export", "fschk", "fix", "rm")
+
+
+def make_image(fn, size_mb, spc, bps=512):
+    total, reserved, n_fats = (size_mb << 20) // bps, 32, 2
+    spf = ((total-reserved)//spc*4 + bps-1) // bps
+    boot, fsinfo = (bytearray(bps), bytearray(bps))
+    boot[:11] = b'\xeb\x58\x90MSWIN4.1'
+    struct.pack_into('<HBHB', boot, 0x0b, bps, spc, reserved, n_fats)
+    struct.pack_into('<I', boot, 0x20, total)
+    struct.pack_into('<IHHIHH', boot, 0x24, spf, 0, 0, 2, 1, 6)
+    boot[510:] = b'\x55\xaa'
+    struct.pack_into('<I', fsinfo, 0, 0x41615252)
+    struct.pack_into('<III', fsinfo, 0x1e4, 0x61417272, 0xffffffff,
+                     0xffffffff)
+    struct.pack_into('<I', fsinfo, 0x1fc, 0xaa550000)
+    with open(fn, 'wb') as fo:
+        fo.truncate(total*bps)
+        fo.write(boot + fsinfo)
+        for i in range(n_fats):
+            fo.seek((reserved+i*spf)*bps)
+            fo.write(struct.pack('<III', 0x0ffffff8, 0x0fffffff, 0x0fffffff))
+
+
+def fragment(reader, level):
+    if level <= 0:
+        return
+    step, clusters = (max(2, round(1/level)), [])
+    for n in range(3, len(reader.free), step):
+        if reader.free[n]:
+            clusters.append(n)
+    for n, next_ in zip(clusters, clusters[1:] + [0x0fffffff]):
+        reader.set_fat(n, next_)
+    reader.cf("FILLER", clusters[0], len(clusters)*reader.len_clus)
+    reader.sync()
+
+
+def make_tree(root, args, rnd, depth=0):
+    sizes, count = ([], 0)
+    makedirs(root)
+    for i in range(args.files):
+        size = int(2 ** rnd.uniform(log2(args.min_size),
+                                    log2(args.max_size)))
+        with open(path.join(root, "f{}.bin".format(i)), 'wb') as fo:
+            fo.write(os.urandom(size))
+        sizes.append(size)
+    if depth < args.depth:
+        for i in range(args.fanout):
+            s, c = make_tree(path.join(root, "d{}".format(i)), args, rnd,
+                             depth+1)
+            sizes.extend(s)
+            count += c + 1
+    return (sizes, count)
+
+
+def io_counters():
+    try:
+        with open("/proc/self/io") as fo:
+            fields = dict(line.split(": ") for line in fo)
+        return {k: int(fields[k]) for k in ("syscr", "syscw", "rchar",
+                                             "wchar")}
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return {}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"inblock": usage.ru_inblock, "oublock": usage.ru_oublock}
+
+
+def measure(name, func, size=0, entries=0):
+    before, start = (io_counters(), perf_counter())
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        func()
+    elapsed, after = (perf_counter()-start, io_counters())
+    result = {"op": name, "seconds": round(elapsed, 6), "bytes": size,
+              "entries": entries,
+              "mb_s": round(size/elapsed/(1 << 20), 3) if size else None,
+              "entries_s": round(entries/elapsed, 1) if entries else None}
+    result.update({k: after[k]-before[k] for k in after})
+    return result
+
+
+def fix(fn):
+    try:
+        Fixer(argparse.Namespace(image=fn))
+    except ErrorsFixed:
+        pass
+
+
+def run(args):
+    rnd, results = (random.Random(args.seed), [])
+    with TemporaryDirectory() as tmp:
+        fn, src, out = (path.join(tmp, "bench.img"), path.join(tmp, "SRC"),
+                        path.join(tmp, "out"))
+        make_image(fn, args.size, args.spc)
+        sizes, n_dirs = make_tree(src, args, rnd)
+        total, entries = (sum(sizes), len(sizes) + n_dirs)
+        files = ["/" + path.relpath(path.join(d, f), tmp)
+                 for d, _, fs in os.walk(src) for f in fs]
+        cons = Cmd(fn, args.mmap)
+        fragment(cons.reader, args.frag)
+        makedirs(out)
+        tasks = {
+            "import": lambda: cons.execute(["import", src, "/"]),
+            "ls": lambda: cons.execute(["ls", "-l", "-R"]),
+            "cat": lambda: [cons.execute(["cat", "-r", f]) for f in files],
+            "hd": lambda: [cons.execute(["hd", f]) for f in files],
+            "export": lambda: cons.execute(["export", "/SRC", out, "-j",
+                                            str(args.jobs)]),
+            "fschk": lambda: cons.execute(["fschk"]),
+            "fix": lambda: fix(fn),
+            "rm": lambda: cons.execute(["rm", "/SRC"])}
+        counts = {"ls": (0, entries), "fschk": (0, entries),
+                  "fix": (0, entries), "rm": (0, entries)}
+        for op in ops:
+            if op not in args.ops and op != "import":
+                continue
+            size, n = counts.get(op, (total, len(sizes)))
+            results.append(measure(op, tasks[op], size, n))
+            if op == "fix":
+                cons.execute(["load", fn])
+        cons.reader.close()
+    config = {k: v for k, v in vars(args).items() if k != "out"}
+    return {"config": config, "total_bytes": total, "entries": entries,
+            "results": results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time Reader and Cmd operations on a synthetic image")
+    parser.add_argument('--size', type=int, default=64,
+                        help="image size in MiB")
+    parser.add_argument('--spc', type=int, default=1,
+                        help="sectors per cluster")
+    parser.add_argument('--frag', type=float, default=0.0,
+                        help="share of clusters taken before import")
+    parser.add_argument('--fanout', type=int, default=3,
+                        help="subdirectories per directory")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="depth of the directory tree")
+    parser.add_argument('--files', type=int, default=8,
+                        help="files per directory")
+    parser.add_argument('--min-size', type=int, default=512,
+                        help="smallest file size in bytes")
+    parser.add_argument('--max-size', type=int, default=1 << 16,
+                        help="largest file size in bytes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="threads used by export")
+    parser.add_argument('--mmap', action="store_true",
+                        help="access image through memory mapping")
+    parser.add_argument('--ops', nargs='+', choices=ops, default=list(ops),
+                        help="operations to time, import always runs")
+    parser.add_argument('--out', type=str, help="write JSON to file")
+    args = parser.parse_args()
+    report = json.dumps(run(args), indent=2)
+    if args.out:
+        with open(args.out, 'w') as fo:
+            fo.write(report + "\n")
+    else:
+        print(report)
@@ -1,9 +1,16 @@
-from reader import Reader, Type
-from hexdump import HexDump
-from argparse import ArgumentParser
+from reader import (Reader, Type, FileNotFoundError, IsADirectoryError,
+                    FileExistsError)
+from stats import stats
+from hexdump import hexdump
+from argparse import ArgumentParser, ArgumentTypeError
 from os import path, listdir, makedirs, lseek
 from os.path import sep
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+from queue import Queue, Empty
+from time import perf_counter
 import codecs
+import sys
 
 # {(Имя, описание): [(Имя аргумента, описание[, дефолт])*]}
 
@@ -27,47 +34,62 @@ commands =\
      ("md", "Make directory"): [("dir", "dir name")],
      ("cf", "Create empty file"): [("file", "file name")],
      ("fschk", "Check file system"): [],
+     ("sync", "Write cached changes to image"): [],
+     ("stats", "Show I/O counters and timings"): [],
      ("help", "Shows help information"): []}
 
 
-class ArgparseWithExit(ArgumentParser):
-    def exit(self, status=0, message=""):
-        raise KeyboardInterrupt(message)
+class PrintableTable(dict):
+    def __missing__(self, c):
+        ch = chr(c)
+        self[c] = c if ch.isprintable() or ch.isspace() else ord('?')
+        return self[c]
 
 
-class NoSuchCommandError(Exception):
-    def __str__(self):
-        return "No such command"
+printable = PrintableTable()
 
 
-class FileNotFoundError(OSError):
-    def __init__(self, fn):
-        super().__init__()
-        self.fn = fn
+def non_negative(value):
+    n = int(value)
+    if n < 0:
+        raise ArgumentTypeError("{}: must not be negative".format(n))
+    return n
 
-    def __str__(self):
-        return "{}: No such file or directory".format(self.fn)
+
+def positive(value):
+    n = int(value)
+    if n < 1:
+        raise ArgumentTypeError("{}: must be positive".format(n))
+    return n
 
 
-class IsADirectoryError(OSError):
-    def __init__(self, fn):
-        super().__init__()
-        self.name = fn
+class ArgparseWithExit(ArgumentParser):
+    def exit(self, status=0, message=""):
+        if message:
+            sys.stderr.write(message)
+        raise KeyboardInterrupt(message)
 
+
+class NoSuchCommandError(Exception):
     def __str__(self):
-        return "{}: is a directory".format(self.name)
+        return "No such command"
 
 
 class Cmd:
-    def __init__(self, image_fn):
-        self.reader = Reader(image_fn)
+    queue_size = 4
+    autosync = True
+
+    def __init__(self, image_fn, use_mmap=False):
+        self.use_mmap = use_mmap
+        self.reader = Reader(image_fn, use_mmap)
         self.dir = sep
         self.init_arg_pars()
         self.actions = {"load": self.load, "ls": self.ls, "cf": self.cf,
                         "import": self.import_file, "export": self.export_file,
                         "cd": self.cd, "md": self.md, "rm": self.rm,
                         "fschk": self.fschk, "cat": self.cat,
-                        "hd": self.hd, "help": self.help}
+                        "hd": self.hd, "help": self.help,
+                        "sync": self.sync, "stats": self.stats}
 
     def init_arg_pars(self):
         self.parsers = {}
@@ -84,13 +106,32 @@ class Cmd:
                                         help="use a long listing format")
         self.parsers["ls"].add_argument('-R', type=int, nargs='?', default=0,
                                         help="list subdirectories recursively")
+        self.parsers["cat"].add_argument('-r', action="store_true",
+                                         help="write raw bytes to stdout")
+        self.parsers["hd"].add_argument('--offset', type=non_negative,
+                                        default=0, help="first byte to show")
+        self.parsers["hd"].add_argument('--length', type=non_negative,
+                                        default=None,
+                                        help="count of bytes to show")
+        self.parsers["export"].add_argument('-j', type=positive, default=1,
+                                            help="number of parallel copies")
+        self.parsers["import"].add_argument(
+            '-p', action="store_true",
+            help="read next files from host while writing current ones")
+        self.parsers["stats"].add_argument('--reset', action="store_true",
+                                           help="clear counters after show")
 
     def execute(self, cmdl):
         name, *args = cmdl
-        if name in self.actions:
-            self.actions[name](self.parsers[name].parse_args(args))
-        else:
+        if name not in self.actions:
             raise NoSuchCommandError
+        start = perf_counter()
+        try:
+            self.actions[name](self.parsers[name].parse_args(args))
+        finally:
+            if self.autosync and self.reader.writable:
+                self.reader.sync()
+            stats.record("cmd." + name, perf_counter()-start)
 
     def cd(self, p):
         d = self.dir
@@ -119,9 +160,18 @@ class Cmd:
         self.dir = sep.join(directory)
 
     def fschk(self, _):
-        self._fake_cd(sep, self.reader.fschk)
+        self.reader.fschk()
         print("fs is ok")
 
+    def sync(self, _):
+        self.reader.sync()
+
+    def stats(self, p):
+        for line in stats.lines():
+            print(line)
+        if p.reset:
+            stats.reset()
+
     def cf(self, p):
         path = p.file.split(sep)
         self._fake_cd(sep.join(path[:-1]), self.reader.cf, path[-1])
@@ -135,11 +185,14 @@ class Cmd:
         self._fake_cd(sep.join(path[:-1]), self._rm, path[-1])
 
     def load(self, p):
-        self.reader, self.dir = (Reader(p.image), sep)
+        reader = Reader(p.image, self.use_mmap)
+        self.reader.close()
+        self.reader, self.dir = (reader, sep)
 
     def cat(self, p):
         path = p.file.split(sep)
-        self._fake_cd(sep.join(path[:-1]), self._cat, p.encoding, path[-1])
+        self._fake_cd(sep.join(path[:-1]), self._cat, p.encoding, path[-1],
+                      p.r)
 
     def ls(self, p):
         self._fake_cd(p.dir, self._ls, p.l, p.R)
@@ -151,18 +204,19 @@ class Cmd:
             print("\n")
 
     def import_file(self, p):
-        self._fake_cd(p.to, self._import, p.fr)
+        self._fake_cd(p.to, self._import_all, p.fr, p.p)
 
     def export_file(self, p):
         path = p.fr.split(sep)
-        self._fake_cd(sep.join(path[:-1]), self._export, path[-1], p.to)
+        self._fake_cd(sep.join(path[:-1]), self._export, path[-1], p.to, p.j)
 
     def hd(self, p):
         path = p.file.split(sep)
         if len(path) == 1:
-            self._hd(path[-1])
+            self._hd(path[-1], p.offset, p.length)
             return
-        self._fake_cd(sep.join(path[:-1]), self._hd, path[-1])
+        self._fake_cd(sep.join(path[:-1]), self._hd, path[-1], p.offset,
+                      p.length)
 
     def add_action(self, name, func, descr):
         self.actions[name] = func
@@ -183,94 +237,176 @@ class Cmd:
         if fn not in '..':
             self.reader.rm(self._find_file(fn))
 
-    def _cat(self, encoding, fn):
+    def _cat(self, encoding, fn, raw=False):
+        if raw:
+            sys.stdout.flush()
+            for data in self._get_data(fn):
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+            return
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
         for data in self._get_data(fn):
-            text = codecs.decode(data, encoding=encoding, errors='replace')
-            text = map(
-                lambda x: x if x.isprintable() or x.isspace() else '?', text)
-            print(''.join(text), end='')
+            sys.stdout.write(decoder.decode(data).translate(printable))
+        sys.stdout.write(decoder.decode(b'', True).translate(printable))
+
+    def _import_all(self, fr, pipelined):
+        jobs = [] if pipelined else None
+        self._import(fr, jobs)
+        if jobs:
+            self._write_imports(jobs)
 
-    def _import(self, fr):
+    def _import(self, fr, jobs=None):
         name = fr.split(sep)[-1]
-        if path.isdir(fr):
-            self.reader.md(name)
-            self.reader.cd(self.reader.current)
-            self.reader.cd(self._find_file(name))
-            for f in listdir(fr):
-                self._import(path.join(fr, f))
+        if not path.isdir(fr):
+            self._import_files([(fr, name)], jobs)
+            return
+        self.reader.md(name)
+        self.reader.cd(self._find_file(name))
+        entries = [(path.join(fr, f), f) for f in listdir(fr)]
+        self._import_files([e for e in entries if not path.isdir(e[0])],
+                           jobs)
+        for dest_fn, _ in entries:
+            if path.isdir(dest_fn):
+                self._import(dest_fn, jobs)
+        self.reader.cd(self.reader.files[1])
+
+    def _export(self, fr, to, jobs=1):
+        file_, work = (None if fr in '..' else self._find_file(fr), [])
+        if file_ is not None and file_.type != Type.dir_:
+            fn = path.join(to, fr) if path.isdir(to) else to
+            work.append((fn, self.reader.get_byte_extents(file_)))
         else:
-            self._import_file_data(fr, name)
-
-    def _export(self, fr, to):
-        try:
             self.cd(self.parsers["cd"].parse_args([fr]))
             dest = path.join(to, self.dir.split(sep)[-2])
-            makedirs(dest, exist_ok=True)
-            for f in self.reader.files:
-                if f.name not in '..':
-                    self._export(f.name, dest)
-            if self.dir != sep:
-                self.cd(self.parsers["cd"].parse_args([".."]))
-        except Exception:
-            fn = path.join(to, fr) if path.isdir(to) else to
-            with open(fn, 'wb') as fo:
-                for data in self._get_data(fr):
-                    fo.write(data)
+            for dir_, _, files in self.reader.walk(self.reader.current,
+                                                   dest):
+                makedirs(dir_, exist_ok=True)
+                work.extend((path.join(dir_, f.name),
+                             self.reader.get_byte_extents(f)) for f in files)
+        self.reader.sync_clusters()
+        if jobs < 2:
+            for job in work:
+                self._copy_job(*job)
+            return
+        with ThreadPoolExecutor(jobs) as pool:
+            list(pool.map(lambda job: self._copy_job(*job), work))
 
-    def _hd(self, fn):
-        n = 0
-        for data in self._get_data(fn):
-            for line in HexDump(data, 16, n).lines:
-                print(line)
-            n += len(data)
+    def _copy_job(self, fn, extents):
+        with open(fn, 'wb') as fo:
+            self.reader.copy_extents(extents, fo.fileno())
+
+    def _hd(self, fn, offset=0, length=None):
+        data = self._get_data(fn, offset, length)
+        for text in hexdump(data, 16, offset):
+            sys.stdout.write(text)
 
     def _rm(self, fn):
         self.reader.rm(self._find_file(fn))
 
-    def _ls(self, use_long, depth_rec, par=[]):
-        if depth_rec is None:
-            depth_rec = -1
-        for f in self.reader.files:
-            fn = str(f)
-            if fn in '..':
-                continue
-            fn = "{}/{}".format("/".join(par), fn) if par else fn
-            print(f.get_line(fn) if use_long else fn)
-            if depth_rec and f.type == Type.dir_:
-                self.reader.cd(f)
-                par.append(f.name)
-                self._ls(use_long, depth_rec-1, par)
-                par.pop()
-                self.reader.cd(self.reader.files[1])
+    def _ls(self, use_long, depth_rec):
+        for dir_, dirs, files in self.reader.walk(self.reader.current, "",
+                                                  True, depth_rec):
+            for f in sorted(dirs + files, key=lambda f: f.blocks):
+                fn = "{}/{}".format(dir_, f) if dir_ else str(f)
+                print(f.get_line(fn) if use_long else fn)
 
     def _find_file(self, name):
-        for file_ in self.reader.files:
-            if file_.name == name:
-                return file_
-        raise FileNotFoundError(name)
+        file_ = self.reader.find(name, True)
+        if file_ is None:
+            raise FileNotFoundError(name)
+        return file_
+
+    def _import_files(self, files, jobs=None):
+        entries, data_jobs, len_clus = ([], [], self.reader.len_clus)
+        names = set()
+        for dest_fn, fn in files:
+            self.reader.check_double(fn)
+            if fn.lower() in names:
+                raise FileExistsError(fn)
+            names.add(fn.lower())
+        try:
+            for dest_fn, fn in files:
+                with open(dest_fn, 'rb') as f:
+                    size = lseek(f.fileno(), 0, 2)
+                count = -(-size // len_clus)
+                extents = self.reader.alloc_extents(count) if size else \
+                    [(0, 0)]
+                entries.append((fn, Type.file_, extents[0][0], size))
+                if size:
+                    data_jobs.append((dest_fn, extents, size))
+            self.reader.add_entries(entries)
+        except Exception:
+            for _, _, start, _ in entries:
+                self.reader.free_chain(start)
+            raise
+        for dest_fn, extents, size in data_jobs:
+            if jobs is not None:
+                jobs.append((dest_fn, extents))
+            elif size <= self.reader.max_chunk:
+                for n, data in self._read_chunks(dest_fn, extents):
+                    self.reader.write_extent(n, data)
+            else:
+                self._write_imports([(dest_fn, extents)])
+
+    def _write_imports(self, jobs):
+        queue, stop = (Queue(self.queue_size), Event())
+        reader = Thread(target=self._read_imports, args=(jobs, queue, stop),
+                        daemon=True)
+        reader.start()
+        try:
+            for item in iter(queue.get, None):
+                if isinstance(item, Exception):
+                    raise item
+                self.reader.write_extent(*item)
+        finally:
+            stop.set()
+            while reader.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    def _read_imports(self, jobs, queue, stop):
+        try:
+            for dest_fn, extents in jobs:
+                for item in self._read_chunks(dest_fn, extents):
+                    if stop.is_set():
+                        return
+                    queue.put(item)
+        except Exception as e:
+            queue.put(e)
+            return
+        queue.put(None)
 
-    def _import_file_data(self, dest_fn, fn):
+    def _read_chunks(self, dest_fn, extents):
+        len_clus = self.reader.len_clus
+        step = max(self.reader.max_chunk // len_clus, 1)
         with open(dest_fn, 'rb') as f:
-            size = lseek(f.fileno(), 0, 2)
-            n = self.reader.add_cluster() if size else 0
-            self.reader.cf(fn, n, size)
-            self.reader.cd(self.reader.current)
-            f.seek(0)
-            data = f.read(self.reader.len_clus)
-            while data:
-                self.reader.upwrite_data_by_cluster(n, data)
-                data = f.read(self.reader.len_clus)
-                if data:
-                    n = self.reader.add_cluster(n)
-
-    def _get_data(self, fn):
+            for first, length in extents:
+                for n in range(first, first+length, step):
+                    count = min(step, first+length-n)
+                    yield (n, f.read(count*len_clus))
+
+    def _find_data_file(self, fn):
         file_ = self._find_file(fn)
         if file_.type == Type.dir_:
             raise IsADirectoryError(path.join(self.dir, file_.name))
-        size = file_.size
-        for data in self.reader.get_data_by_clusters(file_.start):
-            data = data[:size]
-            size -= len(data)
+        return file_
+
+    def _get_data(self, fn, offset=0, length=None):
+        file_ = self._find_data_file(fn)
+        size = file_.size - offset
+        if length is not None:
+            size = min(size, length)
+        if size <= 0:
+            return
+        len_clus = self.reader.len_clus
+        clusters = self.reader.get_clusters(file_.start)
+        clusters = clusters[offset//len_clus:-(-(offset+size)//len_clus)]
+        skip = offset % len_clus
+        for data in self.reader.read_clusters(clusters, True):
+            data = data[skip:skip+size]
+            size, skip = (size-len(data), 0)
             yield data
             if size <= 0:
                 return
@@ -0,0 +1,70 @@
+from struct import Struct
+from datetime import datetime
+
+# name, ext, attr, reserved, crt_tenth, crt_time, crt_date, acc_date,
+# cluster_hi, wrt_time, wrt_date, cluster_lo, size
+short_entry = Struct('<8s3sBBBHHHHHHHI')
+# seq, name1, attr, type, chksum, name2, cluster, name3
+lfn_entry = Struct('<B10sBBB12sH4s')
+
+
+def dos_datetime(dt=None):
+    dt = dt or datetime.now()
+    time = dt.hour << 11 | dt.minute << 5 | dt.second >> 1
+    date = (dt.year-1980) << 9 | dt.month << 5 | dt.day
+    return (date, time, dt.microsecond//10000)
+
+
+def format_time(time):
+    return "{:02}:{:02}:{:02}".format(time >> 11, time >> 5 & 63,
+                                      (time & 31)*2)
+
+
+def format_date(date):
+    return "{:02}.{:02}.{}".format(date & 31, date >> 5 & 15,
+                                   (date >> 9)+1980)
+
+
+def checksum(record):
+    chksum = record[0]
+    for c in record[1:11]:
+        chksum = ((chksum & 1) << 7) + (chksum >> 1) + c & 0xff
+    return chksum
+
+
+def decode_entry(data, offset=0):
+    name, exp, attr, _, _, _, _, _, hi, time, date, lo, size =\
+        short_entry.unpack_from(data, offset)
+    name, exp = (name.rstrip(b' '), exp.rstrip(b' '))
+    if exp:
+        name += b'.' + exp
+    return (name.decode("latin-1"), attr, hi << 16 | lo, time, date, size)
+
+
+def encode_entry(name, exp, attr, start, size):
+    date, time, tenth = dos_datetime()
+    return short_entry.pack(name.ljust(8), exp.ljust(3), attr, 0, tenth,
+                            time, date, date, start >> 16, time, date,
+                            start & 0xffff, size)
+
+
+def decode_lfn(data, offset=0):
+    _, name1, _, _, _, name2, _, name3 = lfn_entry.unpack_from(data, offset)
+    name = name1 + name2 + name3
+    end = name.find(b'\x00\x00')
+    while end > 0 and end % 2:
+        end = name.find(b'\x00\x00', end+1)
+    return name if end < 0 else name[:end]
+
+
+def make_lfn_records(fn, chk_sum):
+    if len(fn) % 26:
+        fn += b'\x00\x00'
+        fn += b'\xff'*(-len(fn) % 26)
+    result, count = ([], len(fn)//26)
+    for k in range(count):
+        part = fn[k*26:(k+1)*26]
+        seq = k+1 | (0x40 if k+1 == count else 0)
+        result.append(lfn_entry.pack(seq, part[:10], 0x0f, 0, chk_sum,
+                                     part[10:22], 0, part[22:]))
+    return b''.join(reversed(result))
@@ -2,6 +2,8 @@
 
 
 from cmd import Cmd
+from stats import stats
+from server import serve
 import shlex
 import argparse
 import re
@@ -11,18 +13,31 @@ import readline
 
 class Fat:
     def __init__(self, args):
-        self.is_act = True
-        self.cons = Cmd(args.image)
+        self.is_act, self.stats_fn = (True, args.stats)
+        self.cons = Cmd(args.image, args.mmap)
         self.cons.add_action("exit", self.exit, "Exit from viwer")
+        if args.script:
+            self.cons.autosync = False
+            try:
+                ok = self.run_script(args.script, args.stop_on_error)
+            finally:
+                self.close()
+            sys.exit(0 if ok else 1)
         if args.cmd:
             self.execute(args.cmd)
+            self.close()
             sys.exit(0)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
-        self.cons.reader.fo.close()
+        self.close()
+
+    def close(self):
+        self.cons.reader.close()
+        if self.stats_fn:
+            stats.dump(self.stats_fn)
 
     def main(self):
         while self.is_act:
@@ -31,14 +46,36 @@ class Fat:
             except EOFError:
                 print()
 
+    def run_script(self, fn, stop_on_error=False):
+        fo, ok = (sys.stdin if fn == "-" else open(fn), True)
+        try:
+            for k, line in enumerate(fo, 1):
+                try:
+                    cmdl = shlex.split(line, comments=True)
+                except ValueError as e:
+                    print("line {}: {}".format(k, e))
+                    cmdl = None
+                if cmdl is None or not self.execute(cmdl):
+                    ok = False
+                    if stop_on_error:
+                        break
+                if not self.is_act:
+                    break
+        finally:
+            if fo is not sys.stdin:
+                fo.close()
+        return ok
+
     def execute(self, cmdl):
         try:
             if cmdl:
                 self.cons.execute(cmdl)
+            return True
         except Exception as e:
             print("{}: {}".format(cmdl[0], e))
         except KeyboardInterrupt:
             pass
+        return False
 
     def exit(self, *_):
         self.is_act = False
@@ -47,11 +84,25 @@ class Fat:
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('image', type=str, help="open image")
+    parser.add_argument('--mmap', action="store_true",
+                        help="access image through memory mapping")
+    parser.add_argument('--stats', type=str, metavar="FILE",
+                        help="dump I/O counters and timings as JSON on exit")
+    parser.add_argument('--script', type=str, metavar="FILE",
+                        help="run commands from file, - for stdin")
+    parser.add_argument('--stop-on-error', action="store_true",
+                        help="stop script at the first failed command")
+    parser.add_argument('--serve', type=str, metavar="SOCKET",
+                        help="serve commands on a unix socket")
     parser.add_argument('cmd', type=str, nargs=argparse.REMAINDER,
                         help='cmd for exec')
     try:
-        with Fat(parser.parse_args()) as fat:
-            fat.main()
+        args = parser.parse_args()
+        with Fat(args) as fat:
+            if args.serve:
+                serve(fat, args.serve)
+            else:
+                fat.main()
     except Exception as e:
         sys.exit(e)
     except KeyboardInterrupt:
@@ -3,7 +3,6 @@
 
 from reader import Reader, get_bytes, Type, PermissionDenied
 from os import path
-from hexdump import HexDump
 import argparse
 import sys
 
@@ -26,42 +25,47 @@ class Fixer(Reader):
         if not self.writable:
             raise PermissionDenied
         self.errors = []
-        visited = [0, 1] + self.fix_self_crossing(self.root.start)
+        visited = {0, 1}
+        visited.update(self.fix_self_crossing(self.root.start))
         visited = self.fix_crosses(visited)
-        self.fo.seek(self.start_fat)
-        losted = []
-        for i in range(self.len_fat//4):
-            if self.read_num(4) and i not in visited:
-                losted.append(i)
+        losted = [i for i, n in enumerate(self.fat) if n and i not in visited]
         self.repair_losted(losted)
-        self.fo.close()
+        self.close()
         raise ErrorsFixed(self.errors)
 
-    def fix_crosses(self, visited, is_root=True):
-        files = self.files
-        isnrt = len(files) < 2 or (files[0].name, files[1].name) != (".", "..")
-        if not is_root:
-            if isnrt:
-                self.fix_dir_struct(self.current)
-            files = files[2:]
-        not_fixed = True
-        while not_fixed:
+    def fix_crosses(self, visited):
+        parents = {}
+        for _, d, dirs, files in self.walk_dirs(self.root, "/"):
+            self.cd(d)
+            if d is not self.root:
+                fs = self.files
+                if len(fs) < 2 or (fs[0].name, fs[1].name) != (".", ".."):
+                    self.ps = parents[d.start]
+                    self.fix_dir_struct(d)
+                    self.cd(d)
+                    dirs[:] = [f for f in self.files[2:]
+                               if f.type == Type.dir_]
+                    files = [f for f in self.files[2:]
+                             if f.type != Type.dir_]
+            for i, f in enumerate(dirs):
+                dirs[i] = self.fix_file(visited, f)
+                parents[dirs[i].start] = d.start
             for f in files:
-                clusters = self.check_crosses(visited, f)
-                size = len(clusters) * self.len_clus
-                visited += clusters
-                if f.type == Type.dir_:
-                    if f.size:
-                        self.fix_size(f, 0)
-                    self.ps = self.current.start
-                    self.cd(f)
-                    self.fix_crosses(visited, False)
-                    self.cd(self.files[1])
-                elif f.size not in range(size-self.len_clus, size+1):
-                    self.fix_size(f, size)
-            not_fixed = False
+                self.fix_file(visited, f)
         return visited
 
+    def fix_file(self, visited, f):
+        clusters = self.check_crosses(visited, f)
+        size = len(clusters) * self.len_clus
+        visited.update(clusters)
+        f = self.find(f.name) or f
+        if f.type == Type.dir_:
+            if f.size:
+                self.fix_size(f, 0)
+        elif f.size not in range(size-self.len_clus, size+1):
+            self.fix_size(f, size)
+        return f
+
     def check_crosses(self, visited, f):
         clusters = self.fix_self_crossing(f.start)
         for c in clusters:
@@ -75,11 +79,8 @@ class Fixer(Reader):
         self.errors.append("Crossed file")
         for c in clusters[1:]:
             if c in visited or f.type == Type.dir_:
-                self.fo.seek(self.root_dir+(c-2)*self.len_clus)
-                data = self.fo.read(self.len_clus)
                 end = self.add_cluster(end)
-                self.fo.seek(self.root_dir+(end-2)*self.len_clus)
-                self.fo.write(data)
+                self.copy_clust(c, end)
             else:
                 end = c
             result.append(end)
@@ -93,8 +94,7 @@ class Fixer(Reader):
             self.cd(self.current)
             end = self.files[-1].start
             if clusters[0] not in visited:
-                self.fo.seek(self.start_fat+clusters[0]*4)
-                self.write(b'\x00'*4)
+                self.set_fat(clusters[0], 0)
             self.copy_clust(clusters[0], end)
         else:
             end = self.add_cluster() if clusters[0] in visited else clusters[0]
@@ -104,10 +104,7 @@ class Fixer(Reader):
         return end
 
     def copy_clust(self, last, new):
-        self.fo.seek(self.root_dir+(last-2)*self.len_clus)
-        data = self.fo.read(self.len_clus)
-        self.fo.seek(self.root_dir+(new-2)*self.len_clus)
-        self.fo.write(data)
+        self.upwrite_data_by_cluster(new, self.read_cluster(last))
 
     def repair_losted(self, losted):
         if losted:
@@ -138,24 +135,23 @@ class Fixer(Reader):
                 break
 
     def get_files(self, losted):
-        files, len_ = [], len(losted)
-        while losted:
-            cs, n = 0, losted.pop(0)
-            start = n
-            while n < 0x0ffffff8 and n in losted:
-                n = self.read_num(4)
-                losted.remove(n)
-            while cs != start:
-                cs, to_rem = start, []
-                for c in losted:
-                    self.fo.seek(self.start_fat+c*4)
-                    if self.read_num(4) == start:
-                        start = c
-                        to_rem.append(c)
-                for c in to_rem:
-                    losted.remove(c)
-            files.append((start, len_-len(losted)))
-            len_ = len(losted)
+        fat, files = (self.fat, [])
+        lost, has_pred, done = [bytearray(len(fat)) for _ in range(3)]
+        for c in losted:
+            lost[c] = 1
+        for c in losted:
+            if fat[c] < len(fat) and lost[fat[c]]:
+                has_pred[fat[c]] = 1
+        heads = [c for c in losted if not has_pred[c]]
+        for start in heads + losted:
+            if done[start]:
+                continue
+            n, count = (start, 0)
+            while n < len(fat) and lost[n] and not done[n]:
+                done[n], count, last, n = (1, count+1, n, fat[n])
+            if n < 0x0ffffff8:
+                self.set_fat(last, 0x0ffffff8)
+            files.append((start, count))
         return files
 
     def fix_self_crossing(self, start):
@@ -163,8 +159,7 @@ class Fixer(Reader):
         result = self.get_clusters(start, err)
         if err:
             self.errors.append("Self-crossed file")
-            self.fo.seek(self.start_fat+result[-1]*4)
-            self.fo.write(b'\xf8\xff\xff\x0f')
+            self.set_fat(result[-1], 0x0ffffff8)
         return result
 
     def fix_size(self, f, size):
@@ -1,41 +1,39 @@
-class HexDump:
-    def __init__(self, block, len_row, start):
-        self.block = block
-        self.k = start
-        self.lr = len_row
-        self.build()
-
-    def build(self):
-        self.lines = []
-        rows = len(self.block) // self.lr + min(len(self.block) % self.lr, 1)
-        for n in range(rows):
-            self.lines.append(self.get_line(n * self.lr))
+ascii_table = bytes(c if c in range(32, 127) else ord(".") for c in range(256))
+
+
+def spaced_hex(data):
+    return data.hex(' ')
+
+
+try:
+    b''.hex(' ')
+except TypeError:
+    def spaced_hex(data):
+        hexed = data.hex()
+        return ' '.join(hexed[i:i+2] for i in range(0, len(hexed), 2))
+
+
+def hexdump(blocks, len_row=16, start=0):
+    tail = b''
+    for block in blocks:
+        data = tail + bytes(block)
+        full = len(data) - len(data) % len_row
+        if full:
+            yield get_rows(data[:full], len_row, start)
+            start += full
+        tail = data[full:]
+    if tail:
+        yield get_rows(tail, len_row, start)
 
 # ---------------------------------------------------------------------#
 
-    def get_line(self, n):
-        result = []
-        result.append(self.get_begin(n))
-        for i in range(n, n + self.lr):
-            try:
-                hexed_byte = "0" + hex(self.block[i])[2:]
-            except IndexError:
-                hexed_byte = " " * 3
-            result.append("{} ".format(hexed_byte[-2:]))
-        result.append(self.get_end(n))
-        return ''.join(result)
-
-    def get_end(self, n):
-        result = ["| "]
-        for i in range(n, self.lr + n):
-            if i < len(self.block):
-                if self.block[i] in range(32, 127):
-                    result.append(chr(self.block[i]))
-                else:
-                    result.append(".")
-            else:
-                result.append(" ")
-        return ''.join(result)
-
-    def get_begin(self, n):
-        return " {} | ".format(("0" * 8 + hex(n+self.k)[2:])[-8:])
+
+def get_rows(data, len_row, start):
+    hexed = spaced_hex(data) + ' '
+    text = data.translate(ascii_table).decode("latin-1")
+    width, lines = (len_row * 3, [])
+    for n in range(0, len(data), len_row):
+        lines.append(" {:08x} | {}| {}\n".format(
+            start + n, hexed[n*3:n*3 + width].ljust(width),
+            text[n:n + len_row].ljust(len_row)))
+    return ''.join(lines)
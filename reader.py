@@ -1,6 +1,18 @@
 from enum import Enum
-from datetime import datetime
-from os import path
+from array import array
+from collections import OrderedDict
+from functools import wraps
+from threading import RLock
+from os import path, lseek
+import errno
+import io
+import mmap
+import os
+from dentry import (decode_entry, encode_entry, decode_lfn, checksum,
+                    make_lfn_records, format_time, format_date)
+from stats import stats
+import sys
+import re
 
 
 class Type(Enum):
@@ -9,18 +21,28 @@ class Type(Enum):
 
 
 class MyFile:
+    __slots__ = ("name", "start", "type", "wtime", "wdate", "size", "blocks")
+
     def __init__(self, name, n, typ, time, date, size, blocks):
         self.name = name
         self.start = n
         self.type = typ
-        self.time = time
-        self.date = date
+        self.wtime = time
+        self.wdate = date
         self.size = size
         self.blocks = blocks
 
     def __str__(self):
         return self.name
 
+    @property
+    def time(self):
+        return format_time(self.wtime)
+
+    @property
+    def date(self):
+        return format_date(self.wdate)
+
     def get_line(self, fn):
         t = "d" if self.type == Type.dir_ else "f"
         date, time, size = (self.date, self.time, self.size)
@@ -52,6 +74,24 @@ class FileExistsError(OSError):
         return "{}: file already exists".format(self.name)
 
 
+class FileNotFoundError(OSError):
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+
+    def __str__(self):
+        return "{}: No such file or directory".format(self.fn)
+
+
+class IsADirectoryError(OSError):
+    def __init__(self, fn):
+        super().__init__()
+        self.name = fn
+
+    def __str__(self):
+        return "{}: is a directory".format(self.name)
+
+
 class NotADirectoryError(OSError):
     def __init__(self, fn):
         self.name = fn
@@ -62,12 +102,16 @@ class NotADirectoryError(OSError):
 
 
 class CrossedCluster(Exception):
-    def __init__(self, cluster):
+    def __init__(self, cluster, first=None, second=None):
         self.cluster = cluster
+        self.owners = (first, second)
         super().__init__()
 
     def __str__(self):
-        return "Crossed cluster {}".format(self.cluster)
+        if self.owners[0] is None:
+            return "Crossed cluster {}".format(self.cluster)
+        return "Crossed cluster {} ({} and {})".format(self.cluster,
+                                                       *self.owners)
 
 
 class LostedCluster(Exception):
@@ -121,134 +165,253 @@ class PermissionDenied(Exception):
 
 
 def get_bytes(num):
-    result = []
-    for i in range(4):
-        result.append(num % 256)
-        num //= 256
-    return bytes(result)
-
-
-def get_date_time():
-    dt = datetime.now()
-    dt = [dt.second//2, dt.minute, dt.hour, dt.day, dt.month, dt.year-1980]
-    sec, minute, hour = map(lambda x: bin(x)[2:], dt[:3])
-    time = ('0'*5+hour)[-5:] + ('0'*6+minute)[-6:] + ('0'*5+sec)[-5:]
-    time = get_bytes(int(time, 2))[:2]
-    day, mon, year = map(lambda x: bin(x)[2:], dt[3:])
-    date = ('0'*7+year)[-7:] + ('0'*4+mon)[-4:] + ('0'*5+day)[-5:]
-    date = get_bytes(int(date, 2))[:2]
-    return (date, time, bytes([datetime.now().microsecond//10000]))
-
-
-def make_lfn_records(fn, chk_sum):
-    result = []
-    k = len(fn) // 26
-    if k*26 < len(fn):
-        fn += b'\x00\x00' + b'\xff'*((k+1)*26 - len(fn)-2)
-    k = 0
-    while fn:
-        data, k = ([], k+1)
-        data.append(bytes([k]))
-        data.append(fn[:10])
-        fn = fn[10:]
-        data.append(b'\x0f\x00')
-        data.append(bytes([chk_sum]))
-        data.append(fn[:12])
-        fn = fn[12:]
-        data.append(b'\x00\x00')
-        data.append(fn[:4])
-        fn = fn[4:]
-        if not fn:
-            n = len(data)-7
-            data.insert(n, bytes([data.pop(n)[0]+0x40]))
-        result.insert(0, b''.join(data))
-    return b''.join(result)
+    return (num & 0xffffffff).to_bytes(4, 'little')
+
+
+def copy_file_range(src, dst, offset, length):
+    return os.copy_file_range(src, dst, length, offset)
+
+
+def sendfile(src, dst, offset, length):
+    return os.sendfile(dst, src, offset, length)
+
+
+def copy_buffered(src, dst, offset, length):
+    return os.write(dst, os.pread(src, min(length, Reader.max_chunk), offset))
+
+
+class ImageFile(io.RawIOBase):
+    def __init__(self, reader, file_):
+        super().__init__()
+        self.reader, self.name, self.pos = (reader, file_.name, 0)
+        self.clusters = array('I', reader.get_clusters(file_.start))
+        self.size = min(file_.size, len(self.clusters)*reader.len_clus)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position {}".format(offset))
+        self.pos = offset
+        return offset
+
+    def readinto(self, buf):
+        reader, buf = (self.reader, memoryview(buf).cast('B'))
+        len_clus, clusters = (reader.len_clus, self.clusters)
+        size, done = (min(len(buf), self.size-self.pos), 0)
+        reader.sync_clusters()
+        while done < size:
+            k, skip = divmod(self.pos, len_clus)
+            first, count = (clusters[k], 1)
+            while k+count < len(clusters) and \
+                    clusters[k+count] == first+count and \
+                    count*len_clus-skip < size-done:
+                count += 1
+            length = min(count*len_clus-skip, size-done)
+            offset = reader.root_dir+(first-2)*len_clus+skip
+            n = reader.read_into(offset, buf[done:done+length])
+            if not n:
+                break
+            done, self.pos = (done+n, self.pos+n)
+        return done
+
+
+def pread_into(fd, buf, offset):
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [buf], offset)
+    data = os.pread(fd, len(buf), offset)
+    buf[:len(data)] = data
+    return len(data)
+
+
+def locked(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 class Reader:
-    def __init__(self, fn):
+    max_chunk = 1 << 22
+    dcache_size = 256
+    cache_size = 1 << 23
+
+    def __init__(self, fn, use_mmap=False):
         try:
             self.fo, self.writable = (open(fn, 'rb+'), True)
         except Exception:
             self.fo, self.writable = (open(fn, 'rb'), False)
-        self.fn = fn
-        self.fo.seek(0x0b)
-        data = list(map(lambda x: self.read_num(x), [2, 1, 2, 1]))
+        self.fn, self.fd, self.mm = (fn, self.fo.fileno(), None)
+        self.lock = RLock()
+        boot = self.read_at(0, 0x32)
+        if len(boot) < 0x32:
+            raise BrokenFATError
+        data = [self.read_num(n, boot[i:i+n])
+                for i, n in [(0x0b, 2), (0x0d, 1), (0x0e, 2), (0x10, 1)]]
         for peace in data:
             if not peace:
                 raise BrokenFATError
         self.b_per_sec, self.sec_per_clus, res_sec, self.n_of_fats = data
-        self.fo.seek(0x24)
-        self.sec_per_fat = self.read_num(2)
+        total_sec = self.read_num(2, boot[0x13:0x15])
+        total_sec = total_sec or self.read_num(4, boot[0x20:0x24])
+        self.sec_per_fat = self.read_num(4, boot[0x24:0x28])
         if not self.sec_per_fat:
             raise BrokenFATError
+        self.fsinfo = self.read_num(2, boot[0x30:0x32])
+        if self.fsinfo == 0xffff:
+            self.fsinfo = 0
+        self.fsinfo *= self.b_per_sec
         self.start_fat = res_sec*self.b_per_sec
         self.len_fat = self.sec_per_fat*self.b_per_sec
         self.root_dir = self.n_of_fats*self.len_fat+self.start_fat
         self.len_clus = self.sec_per_clus*self.b_per_sec
-        date_time = ("00:00:00", "01.01.1980")
-        self.root = MyFile("root", 2, Type.dir_, *date_time, 0, (0, 0))
+        if use_mmap:
+            self.map_image()
+        self.load_fat()
+        len_data = total_sec*self.b_per_sec - self.root_dir
+        self.n_clusters = min(len(self.fat), len_data//self.len_clus + 2)
+        self.load_free()
+        self.root = MyFile("root", 2, Type.dir_, 0, 0x21, 0, (0, 0))
+        self.dcache, self.dcache_owner = (OrderedDict(), {})
+        self.ccache, self.ccache_dirty = (OrderedDict(), set())
+        if self.mm is not None:
+            self.cache_size = 0
+        self.copy_funcs = [copy_file_range, sendfile, copy_buffered]
         self.current = self.root
         self.cd(self.root)
 
+    @locked
     def fschk(self):
-        errors = []
-        visited = self.get_clusters(self.root.start, errors) + [0, 1]
-        visited, errors = self.check_crosses(visited)
-        for i in range(self.len_fat//4):
-            self.fo.seek(self.start_fat+i*4)
-            if self.read_num(4) and i not in visited:
+        errors, paths = ([], ["/"])
+        owner = array('i', [-1])*len(self.fat)
+        owner[0] = owner[1] = 0
+        clusters = self.get_clusters(self.root.start, errors)
+        self.mark_clusters(clusters, "/", owner, paths, errors)
+        for dir_, d, dirs, files in self.walk_dirs(self.root, "/"):
+            self.check_crosses(d, dir_, dirs, files, owner, paths, errors)
+        for i, n in enumerate(self.fat):
+            if n and owner[i] < 0:
                 errors.append(str(LostedCluster(i)))
         if errors:
             raise AllFATErrors(errors)
 
-    def check_crosses(self, visited, dir_="/", errors=[]):
-        files = self.files
-        isrt = len(files) < 2 or (files[0].name, files[1].name) != (".", "..")
+    def check_crosses(self, d, dir_, dirs, files, owner, paths, errors):
         if dir_ != "/":
-            if isrt:
+            fs = self.read_dir(d.start)[0]
+            if len(fs) < 2 or (fs[0].name, fs[1].name) != (".", ".."):
                 errors.append(str(WrongDirStruct(dir_)))
-            files = files[2:]
-        for f in files:
+        for f in dirs + files:
             directory = path.join(dir_, f.name)
             clusters = self.get_clusters(f.start, errors)
             size = len(clusters)*self.len_clus
-            for c in clusters:
-                if c in visited:
-                    errors.append(str(CrossedCluster(c)))
-                visited.append(c)
+            crossed = self.mark_clusters(clusters, directory, owner, paths,
+                                         errors)
             if f.type == Type.dir_:
                 if f.size:
                     errors.append(str(NonZeroDirSize(directory)))
-                self.cd(f)
-                self.check_crosses(visited, directory, errors)
-                self.cd(self.files[1])
-            elif f.size not in range(size-self.len_clus, size+1):
+                if crossed:
+                    dirs.remove(f)
+            elif not size-self.len_clus <= f.size <= size:
                 errors.append(str(BrokenFileSize(directory)))
-        return (visited, errors)
 
+    def walk(self, top=None, top_path="/", topdown=True, depth=None):
+        for dir_, _, dirs, files in self.walk_dirs(top or self.root, top_path,
+                                                   topdown, depth):
+            yield (dir_, dirs, files)
+
+    def walk_dirs(self, top, top_path, topdown=True, depth=None, seen=None):
+        seen = set() if seen is None else seen
+        start = top.start or self.root.start
+        seen.add(start)
+        dirs, files = ([], [])
+        for f in self.read_dir(start)[0]:
+            if f.name not in (".", ".."):
+                (dirs if f.type == Type.dir_ else files).append(f)
+        if topdown:
+            yield (top_path, top, dirs, files)
+        if depth is None or depth > 0:
+            depth = None if depth is None else depth-1
+            for d in dirs:
+                if (d.start or self.root.start) not in seen:
+                    yield from self.walk_dirs(d, path.join(top_path, d.name),
+                                              topdown, depth, seen)
+        if not topdown:
+            yield (top_path, top, dirs, files)
+
+    def mark_clusters(self, clusters, fn, owner, paths, errors):
+        k, crossed = (len(paths), False)
+        paths.append(fn)
+        for c in clusters:
+            if owner[c] >= 0:
+                errors.append(str(CrossedCluster(c, paths[owner[c]], fn)))
+                crossed = True
+            else:
+                owner[c] = k
+        return crossed
+
+    @locked
     def md(self, dn, check=True):
         if not self.writable:
             raise PermissionDenied
         if check:
             self.check_double(dn)
         start, cur_start = (self.add_cluster(), self.current.start)
-        self.make_new_records(dn, Type.dir_, start)
+        self.add_entries([(dn, Type.dir_, start, 0)], False)
         data = self.make_dos_record(b'.', Type.dir_, start, 0) +\
             self.make_dos_record(b'..', Type.dir_, cur_start, 0)
         self.write_data(start, data+self.get_data(start)[64:])
 
+    @locked
     def cf(self, fn, start=0, size=0):
         if not self.writable:
             raise PermissionDenied
-        self.check_double(fn)
-        self.make_new_records(fn, Type.file_, start, size)
+        self.add_entries([(fn, Type.file_, start, size)])
+
+    @locked
+    def resolve(self, fn):
+        file_ = self.root if fn.startswith("/") else self.current
+        for name in fn.split("/"):
+            if name in ("", ".") or name == ".." and file_ is self.root:
+                continue
+            if file_.type != Type.dir_:
+                raise NotADirectoryError(file_.name)
+            _, index, index_ci = self.read_dir(file_.start or self.root.start)
+            file_ = index.get(name) or index_ci.get(name.lower())
+            if file_ is None:
+                raise FileNotFoundError(fn)
+            if file_.type == Type.dir_ and not file_.start:
+                file_ = self.root
+        return file_
+
+    @locked
+    def open(self, fn):
+        file_ = self.resolve(fn)
+        if file_.type == Type.dir_:
+            raise IsADirectoryError(fn)
+        return ImageFile(self, file_)
 
     def check_double(self, fn):
-        for f in self.files:
-            if f.name == fn:
-                raise FileExistsError(fn)
+        if self.find(fn, True):
+            raise FileExistsError(fn)
 
+    def find(self, fn, ignore_case=False):
+        if fn in self.index or not ignore_case:
+            return self.index.get(fn)
+        return self.index_ci.get(fn.lower())
+
+    @locked
     def cd(self, file_):
         if file_.type != Type.dir_:
             raise NotADirectoryError(file_.name)
@@ -256,156 +419,468 @@ class Reader:
             self.cd(self.root)
             return
         self.current = file_
-        data = self.get_data(file_.start)
-        name, self.files, k = (b'', [], 0)
+        self.files, self.index, self.index_ci = self.read_dir(file_.start)
+
+    @locked
+    def read_dir(self, start):
+        if start in self.dcache:
+            self.dcache.move_to_end(start)
+            return self.dcache[start][0]
+        return self.cache_dir(start, self.parse_dir(start))
+
+    @stats.timed("parse_dir")
+    def parse_dir(self, start):
+        data = memoryview(self.get_data(start))
+        lfn, first, dir_ = ([], None, ([], {}, {}))
         for i in range(len(data)//32):
-            if k > 0:
-                k -= 1
+            if data[i*32] in (0xe5, 0x00):
+                lfn, first = ([], None)
                 continue
-            block = data[i*32:(i+1)*32]
-            if block[0] in [0xe5, 0x00]:
+            first = i if first is None else first
+            if data[i*32+0x0b] == 0x0f:
+                lfn.append(decode_lfn(data, i*32))
                 continue
-            while block[0x0b] == 0x0f:
-                k += 1
-                name = self.parse_record(block)+name
-                block = data[(i+k)*32:(i+k+1)*32]
-            name = name.decode('utf-16')
-            start, typ, time, date, namen, size = self.get_info(block)
-            if not name:
-                name = namen
-            f = MyFile(name, start, typ, time, date, size, (i, k+1))
-            self.files.append(f)
-            name = b''
-
+            name = b''.join(reversed(lfn)).decode('utf-16-le')
+            f = self.make_file(name, data, i*32, (first, i-first+1))
+            self.add_file(f, dir_)
+            lfn, first = ([], None)
+        return dir_
+
+    def cache_dir(self, start, dir_):
+        if start in self.dcache:
+            self.drop_dir(start)
+        chain = self.get_clusters(start)
+        self.dcache[start] = (dir_, chain)
+        for c in chain:
+            self.dcache_owner[c] = start
+        while len(self.dcache) > self.dcache_size:
+            self.drop_dir(next(iter(self.dcache)))
+        return dir_
+
+    def cache_current(self):
+        dir_ = (self.files, self.index, self.index_ci)
+        self.cache_dir(self.current.start or self.root.start, dir_)
+
+    def drop_dir(self, start):
+        _, chain = self.dcache.pop(start)
+        for c in chain:
+            if self.dcache_owner.get(c) == start:
+                del self.dcache_owner[c]
+
+    def invalidate_dir(self, n):
+        start = self.dcache_owner.get(n)
+        if start is not None:
+            self.drop_dir(start)
+
+    def make_file(self, name, data, offset, blocks):
+        namen, attr, start, time, date, size = decode_entry(data, offset)
+        typ = Type.dir_ if attr & 0x10 else Type.file_
+        return MyFile(name or namen, start, typ, time, date, size, blocks)
+
+    def add_file(self, f, dir_=None):
+        files, index, index_ci = dir_ or (self.files, self.index,
+                                          self.index_ci)
+        files.append(f)
+        index[f.name] = f
+        index_ci.setdefault(f.name.lower(), f)
+
+    def remove_file(self, fn):
+        f = self.index.pop(fn)
+        self.files.remove(f)
+        if self.index_ci.get(fn.lower()) is f:
+            del self.index_ci[fn.lower()]
+            for other in self.files:
+                if other.name.lower() == fn.lower():
+                    self.index_ci[fn.lower()] = other
+                    break
+
+    @locked
     def rm(self, file_):
         if not self.writable:
             raise PermissionDenied
         if file_.type == Type.dir_:
-            self.cd(file_)
-            for f in self.files:
-                if f.name not in "..":
-                    self.rm(f)
-            self.cd(self.files[1])
-        n = file_.start
-        while n < 0x0ffffff8 and n:
-            start = self.start_fat + n * 4
-            self.fo.seek(start)
-            n = self.read_num(4)
-            self.fo.seek(start)
-            self.fo.write(b'\0'*4)
+            for _, dirs, files in self.walk(file_, file_.name, False):
+                for f in dirs + files:
+                    self.free_chain(f.start)
+        self.free_chain(file_.start)
         self.del_dir_record(*file_.blocks)
+        self.remove_file(file_.name)
+        self.cache_current()
+
+    def free_chain(self, start):
+        for n in self.get_clusters(start):
+            self.set_fat(n, 0)
 
 # -------------------------------------------------------------------- #
 
-    def make_new_records(self, dn, typ, start, size=0):
-        dir_name = dn.encode("latin-1") if dn in '..' else b' '
-        dos_rec = self.make_dos_record(dir_name, typ, start, size)
-        chksum = dos_rec[0]
-        for i in range(1, 11):
-            chksum = (((chksum & 1) << 7) + (chksum >> 1) + dos_rec[i]) % 256
-        data = make_lfn_records(dn.encode('utf-16')[2:], chksum) + dos_rec
+    @locked
+    def add_entries(self, entries, check=True):
+        if not self.writable:
+            raise PermissionDenied
+        names, records = (set(), [])
+        for k, (fn, typ, start, size) in enumerate(entries):
+            if check:
+                self.check_double(fn)
+                if fn.lower() in names:
+                    raise FileExistsError(fn)
+                names.add(fn.lower())
+            dir_name = fn.encode("latin-1") if fn in '..' else b' '
+            dos_rec = self.make_dos_record(dir_name, typ, start, size,
+                                           len(self.files)+k)
+            lfn = make_lfn_records(fn.encode('utf-16-le'), checksum(dos_rec))
+            records.append((fn, dos_rec, lfn+dos_rec))
+        chain = self.get_clusters(self.current.start)
+        data = bytearray(self.get_data(self.current.start))
+        free = len(data)//32
+        while free and not data[(free-1)*32]:
+            free -= 1
+        pos = free*32
+        grow = -(-(pos+sum(len(r[2]) for r in records)-len(data)) //
+                 self.len_clus)
+        if grow > 0:
+            for first, count in self.alloc_extents(grow, chain[-1]):
+                chain.extend(range(first, first+count))
+            data += bytes(grow*self.len_clus)
+        for fn, dos_rec, rec in records:
+            data[pos:pos+len(rec)] = rec
+            blocks = (pos//32, len(rec)//32)
+            self.add_file(self.make_file(fn, dos_rec, 0, blocks))
+            pos += len(rec)
+        for i in range(free*32//self.len_clus, -(-pos//self.len_clus)):
+            clus = data[i*self.len_clus:(i+1)*self.len_clus]
+            self.upwrite_data_by_cluster(chain[i], clus)
+        self.cache_current()
+
+    def map_image(self):
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        size = lseek(self.fd, 0, 2)
+        self.mm = mmap.mmap(self.fd, size, access=access)
+        self.view = memoryview(self.mm)
+
+    def load_fat(self):
+        self.fat_dirty = set()
+        self.fat_mapped = self.mm is not None and sys.byteorder == 'little'
+        if self.fat_mapped:
+            end = self.start_fat+self.len_fat
+            self.fat = self.view[self.start_fat:end].cast('I')
+            return
+        self.fat = array('I')
+        self.fat.frombytes(self.read_at(self.start_fat, self.len_fat))
+        if sys.byteorder != 'little':
+            self.fat.byteswap()
+
+    def load_free(self):
+        self.free = bytearray(not n for n in self.fat[:self.n_clusters])
+        self.free[:2] = b'\x00\x00'
+        self.free_count, self.next_free = (self.free.count(1), 2)
+        self.alloc_changed = False
+        data = self.read_at(self.fsinfo, 0x1f0) if self.fsinfo else b''
+        if len(data) < 0x1f0:
+            self.fsinfo = 0
+        else:
+            sig, sig_struct, next_free = [self.read_num(4, data[i:i+4])
+                                          for i in [0, 0x1e4, 0x1ec]]
+            if (sig, sig_struct) != (0x41615252, 0x61417272):
+                self.fsinfo = 0
+            elif 2 <= next_free < self.n_clusters:
+                self.next_free = next_free
+
+    def write_fsinfo(self):
+        if self.fsinfo and self.writable and self.alloc_changed:
+            self.write_at(self.fsinfo+0x1e8,
+                          get_bytes(self.free_count)+get_bytes(self.next_free))
+        self.alloc_changed = False
+
+    @locked
+    def sync(self):
+        self.sync_clusters()
+        self.sync_fat()
+        self.write_fsinfo()
+
+    @locked
+    def flush(self):
+        self.sync()
+        if not self.writable:
+            return
+        if self.mm is not None:
+            self.mm.flush()
+
+    @locked
+    def close(self):
+        self.flush()
+        if self.mm is not None:
+            if self.fat_mapped:
+                self.fat.release()
+            self.view.release()
+            try:
+                self.mm.close()
+            except BufferError:
+                pass
+        self.fo.close()
+
+    def read_at(self, offset, size):
+        stats.add("reads")
+        stats.add("read_bytes", size)
+        if self.mm is not None:
+            return self.view[offset:offset+size]
+        return os.pread(self.fd, size, offset)
+
+    def read_into(self, offset, buf):
+        stats.add("reads")
+        stats.add("read_bytes", len(buf))
+        if self.mm is not None:
+            data = self.view[offset:offset+len(buf)]
+            buf[:len(data)] = data
+            return len(data)
+        return pread_into(self.fd, buf, offset)
+
+    def write_at(self, offset, data):
+        stats.add("writes")
+        stats.add("write_bytes", len(data))
+        if self.mm is not None:
+            self.view[offset:offset+len(data)] = data
+            return
+        data = memoryview(data)
         while data:
-            data = self.add_entry(data)
-            if data:
-                last = self.add_cluster(last)
+            n = os.pwrite(self.fd, data, offset)
+            data, offset = (data[n:], offset+n)
+
+    @locked
+    def read_cluster(self, n):
+        data = self.ccache.get(n)
+        if data is not None:
+            self.ccache.move_to_end(n)
+            stats.add("cache_hits")
+            return data
+        stats.add("cache_misses")
+        data = self.read_at(self.root_dir+(n-2)*self.len_clus, self.len_clus)
+        if self.cache_size >= self.len_clus:
+            self.cache_cluster(n, data)
+        return data
+
+    @locked
+    def cache_cluster(self, n, data, dirty=False):
+        if self.cache_size < self.len_clus:
+            if dirty:
+                self.write_at(self.root_dir+(n-2)*self.len_clus, data)
+            return
+        self.ccache[n] = data
+        self.ccache.move_to_end(n)
+        if dirty:
+            self.ccache_dirty.add(n)
+        while len(self.ccache)*self.len_clus > self.cache_size:
+            self.evict_cluster(next(iter(self.ccache)))
+
+    def evict_cluster(self, n):
+        data = self.ccache.pop(n)
+        if n in self.ccache_dirty:
+            self.ccache_dirty.remove(n)
+            self.write_at(self.root_dir+(n-2)*self.len_clus, data)
+
+    @locked
+    def drop_clusters(self, first, count=1):
+        if count < len(self.ccache):
+            drop = [n for n in range(first, first+count) if n in self.ccache]
+        else:
+            drop = [n for n in self.ccache if first <= n < first+count]
+        for n in drop:
+            del self.ccache[n]
+            self.ccache_dirty.discard(n)
+
+    @locked
+    def sync_clusters(self):
+        for n in sorted(self.ccache_dirty):
+            self.write_at(self.root_dir+(n-2)*self.len_clus, self.ccache[n])
+        self.ccache_dirty.clear()
+
+    def write_fat(self, start, end):
+        per_sec = self.b_per_sec // 4
+        self.fat_dirty.update(range(start//per_sec, (end-1)//per_sec+1))
+
+    @locked
+    def set_fat(self, n, value):
+        self.invalidate_dir(n)
+        self.alloc_changed = True
+        if 2 <= n < self.n_clusters:
+            self.free_count += bool(self.fat[n]) - bool(value)
+            self.free[n] = not value
+        self.fat[n] = value
+        self.fat_dirty.add(n*4 // self.b_per_sec)
+        if not value:
+            self.drop_clusters(n)
+
+    def sync_fat(self):
+        per_sec, runs = (self.b_per_sec // 4, [])
+        for sec in sorted(self.fat_dirty):
+            if runs and runs[-1][1] == sec:
+                runs[-1][1] += 1
+            else:
+                runs.append([sec, sec+1])
+        first_copy = 1 if self.fat_mapped else 0
+        for start, end in runs:
+            table = self.fat[start*per_sec:end*per_sec]
+            if sys.byteorder != 'little':
+                table.byteswap()
+            data = table.tobytes()
+            for k in range(first_copy, self.n_of_fats):
+                offset = self.start_fat+k*self.len_fat+start*self.b_per_sec
+                self.write_at(offset, data)
+        self.fat_dirty.clear()
 
     def find_last_cluster(self, file_):
-        n = self.start_fat + file_.start * 4
-        self.fo.seek(n)
-        s = self.start_fat + self.read_num(4) * 4
-        while s < 0x0ffffff8:
-            n = s
-            self.fo.seek(s)
-            s = self.start_fat + self.read_num(4) * 4
+        n, fat = (file_.start, self.fat)
+        while 1 < fat[n] < min(0x0ffffff8, len(fat)):
+            n = fat[n]
         return n
 
+    @locked
     def get_clusters(self, n, err=None):
         if err is None:
             err = []
-        result = []
-        while n < 0x0ffffff8 and n > 1:
+        result, seen, fat = ([], set(), self.fat)
+        while 1 < n < min(0x0ffffff8, len(fat)):
             result.append(n)
-            self.fo.seek(self.start_fat+n*4)
-            n = self.read_num(4)
-            if n in result:
+            seen.add(n)
+            n = fat[n]
+            if n in seen:
                 err.append(str(CrossedCluster(n)))
                 return result
         return result
 
+    def find_free(self):
+        n = self.free.find(1, self.next_free)
+        if n < 0:
+            n = self.free.find(1, 2, self.next_free)
+        if n < 0:
+            raise FreeSpaceError
+        return n
+
+    @locked
+    @stats.timed("add_cluster")
     def add_cluster(self, end=None):
-        self.fo.seek(self.start_fat)
-        for n in range(self.len_fat//4):
-            if not self.read_num(4):
-                if end:
-                    self.fo.seek(self.start_fat+end*4)
-                    self.fo.write(get_bytes(n))
-                self.fo.seek(self.start_fat+n*4)
-                self.fo.write(b'\xff'*4)
-                self.fo.seek(self.root_dir+(n-2)*self.len_clus)
-                self.fo.write(b'\x00'*self.len_clus)
-                return n
-        raise FreeSpaceError
-
-    def make_dos_record(self, fn, typ, start, size):
-        data = []
-        start = get_bytes(start)
-        dosname = str(len(self.files)).encode('latin-1')
+        n = self.find_free()
+        self.next_free, self.alloc_changed = (n + 1, True)
+        if end:
+            self.set_fat(end, n)
+        self.set_fat(n, 0xffffffff)
+        self.cache_cluster(n, bytes(self.len_clus), True)
+        return n
+
+    @locked
+    def alloc_extents(self, count, end=None):
+        if count > self.free_count:
+            raise FreeSpaceError
+        run = b'\x01'*count
+        n = self.free.find(run, self.next_free)
+        if n < 0:
+            n = self.free.find(run, 2)
+        if n >= 0:
+            extents = [(n, count)]
+        else:
+            runs = [(m.end()-m.start(), m.start())
+                    for m in re.finditer(b'\x01+', self.free)]
+            extents = []
+            for length, n in sorted(runs, reverse=True):
+                extents.append((n, min(length, count)))
+                count -= extents[-1][1]
+                if not count:
+                    break
+            extents.sort()
+        self.link_extents(extents, end)
+        return extents
+
+    def link_extents(self, extents, end=None):
+        nexts = [n for n, _ in extents[1:]] + [0xffffffff]
+        for (n, length), next_ in zip(extents, nexts):
+            self.fat[n:n+length] = array('I', range(n+1, n+length+1))
+            self.fat[n+length-1] = next_
+            self.free[n:n+length] = bytes(length)
+            self.free_count -= length
+            self.write_fat(n, n+length)
+        n, length = extents[-1]
+        self.next_free, self.alloc_changed = (n + length, True)
+        if end:
+            self.set_fat(end, extents[0][0])
+
+    @locked
+    def write_extent(self, n, data):
+        tail = -len(data) % self.len_clus
+        if tail:
+            data = bytes(data) + bytes(tail)
+        self.drop_clusters(n, len(data)//self.len_clus)
+        self.write_at(self.root_dir+(n-2)*self.len_clus, data)
+
+    def make_dos_record(self, fn, typ, start, size, n=None):
+        n = len(self.files) if n is None else n
+        dosname = str(n).encode('latin-1')
         name, exp = (fn, b'') if fn in b'..' else (dosname[:8], dosname[8:])
-        data.append((name+b' '*8)[:8])
-        data.append((exp+b' '*3)[:3])
-        data.append(b'\x10\x00' if typ == Type.dir_ else b'\x20\x00')
-        date, time, ss = get_date_time()
-        table_data = [ss, time, date, date, start[2:], time, date, start[:2]]
-        for e in table_data:
-            data.append(e)
-        data.append(get_bytes(size))
-        return b''.join(data)
-
-    def get_info(self, block):
-        indexes = [0x1a, 0x1b, 0x14, 0x15]
-        for i in range(len(indexes)):
-            indexes[i] = block[indexes[i]]*(256**i)
-        start = sum(indexes)
-        typ, n, size = (Type.file_, 0, 0)
-        if block[0x0b] & 0x10:
-            typ = Type.dir_
-        for i in range(0x16, 0x1a):
-            n += block[i]*256**(i-0x16)
-            size += block[i+6]*256**(i-0x16)
-        n = ("0"*32 + bin(n)[2:])[-32:]
-        data = [n[16:21], n[21:-5], n[-5:], n[11:16], n[7:11], n[:7]]
-        for i in range(len(data)):
-            data[i] = int(data[i], 2)
-        for i in [0, 1, 3, 4]:
-            data[i] = ("00" + str(data[i]))[-2:]
-        time = "{}:{}:{}".format(data[0], data[1], ("0"+str(data[2]*2))[-2:])
-        date = "{}.{}.{}".format(data[3], data[4], data[5]+1980)
-        name = block[:8].decode("latin-1")
-        exp = block[8:11].decode("latin-1")
-        while name[-1] == " ":
-            name = name[:-1]
-        if exp != "   ":
-            while name[-1] == " ":
-                name = name[:-1]
-            name = "{}.{}".format(name, exp)
-        return (start, typ, time, date, name, size)
-
-    def get_data_by_clusters(self, start):
-        clusters = self.get_clusters(start)
-        for c in clusters:
-            self.fo.seek(self.root_dir+(c-2)*self.len_clus)
-            yield self.fo.read(self.len_clus)
+        attr = 0x10 if typ == Type.dir_ else 0x20
+        return encode_entry(name, exp, attr, start, size)
 
-    def add_entry(self, data):
-        d_data = self.get_data(self.current.start)
-        for i in range(len(d_data)//32):
-            if not d_data[i*32]:
-                d_data = d_data[:i*32] + data[:32] + d_data[(i+1)*32:]
-                data = data[32:]
-            if not data:
+    def get_extents(self, clusters):
+        extents = []
+        for c in clusters:
+            if extents and sum(extents[-1]) == c:
+                extents[-1][1] += 1
+            else:
+                extents.append([c, 1])
+        return extents
+
+    @locked
+    def get_byte_extents(self, file_):
+        extents, size = ([], file_.size)
+        for first, count in self.get_extents(self.get_clusters(file_.start)):
+            if size <= 0:
                 break
-        self.write_data(self.current.start, d_data)
-        return data
+            extents.append((self.root_dir+(first-2)*self.len_clus,
+                            min(count*self.len_clus, size)))
+            size -= extents[-1][1]
+        return extents
+
+    def copy_extents(self, extents, fd):
+        for offset, length in extents:
+            while length > 0:
+                n = self.copy_range(fd, offset, length)
+                if not n:
+                    raise BrokenFATError
+                stats.add("copies")
+                stats.add("copy_bytes", n)
+                offset, length = (offset+n, length-n)
+
+    def copy_range(self, fd, offset, length):
+        unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                       errno.EOPNOTSUPP)
+        while True:
+            func = self.copy_funcs[0]
+            try:
+                return func(self.fd, fd, offset, length)
+            except AttributeError:
+                pass
+            except OSError as e:
+                if e.errno not in unsupported or len(self.copy_funcs) == 1:
+                    raise
+            with self.lock:
+                if func in self.copy_funcs:
+                    self.copy_funcs.remove(func)
+
+    def get_data_by_clusters(self, start, reuse=False):
+        return self.read_clusters(self.get_clusters(start), reuse)
+
+    @stats.timed("read_clusters")
+    def read_clusters(self, clusters, reuse=False):
+        step = max(self.max_chunk // self.len_clus, 1)
+        buf = None
+        self.sync_clusters()
+        if reuse and self.mm is None:
+            buf = memoryview(bytearray(step*self.len_clus))
+        for first, count in self.get_extents(clusters):
+            for n in range(first, first+count, step):
+                offset = self.root_dir+(n-2)*self.len_clus
+                size = min(step, first+count-n)*self.len_clus
+                if buf is None:
+                    yield self.read_at(offset, size)
+                else:
+                    yield buf[:self.read_into(offset, buf[:size])]
 
     def clear_dir(self):
         d_data = self.get_data(self.current.start)
@@ -417,38 +892,40 @@ class Reader:
                 d_data = d_data[:i*32] + d_data[(i+1)*32:] + zeroes
         self.write_data(self.current.start, d_data)
 
+    @locked
+    @stats.timed("upwrite_data_by_cluster")
     def upwrite_data_by_cluster(self, n, data):
         if len(data) > self.len_clus:
-            raise BigDataForCluster
-        self.fo.seek(self.root_dir+(n-2)*self.len_clus)
-        self.fo.write(data)
+            raise BigDataForClusterError
+        self.invalidate_dir(n)
+        if len(data) < self.len_clus:
+            data = bytes(data) + bytes(self.read_cluster(n)[len(data):])
+        self.cache_cluster(n, bytes(data), True)
 
+    @locked
     def write_data(self, start, data):
         while start < 0x0ffffff8:
             self.upwrite_data_by_cluster(start, data[:self.len_clus])
             data = data[self.len_clus:]
-            self.fo.seek(self.start_fat+start*4)
-            start = self.read_num(4)
+            start = self.fat[start]
 
+    @locked
     def del_dir_record(self, start, length):
-        data = list(self.get_data(self.current.start))
-        for i in range(start, start+length):
-            data[i*32] = 0xe5
-        self.write_data(self.current.start, bytes(data))
-
-    def read_num(self, n, num=None):
+        chain = self.get_clusters(self.current.start)
+        per_clus = self.len_clus//32
+        for k in range(start//per_clus, (start+length-1)//per_clus+1):
+            data = bytearray(self.read_cluster(chain[k]))
+            for i in range(max(start, k*per_clus),
+                           min(start+length, (k+1)*per_clus)):
+                data[(i-k*per_clus)*32] = 0xe5
+            self.upwrite_data_by_cluster(chain[k], data)
+
+    def read_num(self, n, num):
         result = 0
-        data = num if num else self.fo.read(n)
         for i in range(n):
-            result += data[i]*(256**i)
+            result += num[i]*(256**i)
         return result
 
+    @locked
     def get_data(self, start):
-        return b''.join(self.get_data_by_clusters(start))
-
-    def parse_record(self, record):
-        name = record[1:11]+record[14:26]+record[28:]
-        for i in range(len(name)//2):
-            if name[i*2:(i+1)*2] == b'\x00\x00':
-                return name[:i*2]
-        return name
+        return b''.join(map(self.read_cluster, self.get_clusters(start)))
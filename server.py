@@ -0,0 +1,136 @@
+#!/usr/bin/env python3.6
+
+
+from http.server import BaseHTTPRequestHandler
+from socketserver import UnixStreamServer
+from contextlib import redirect_stdout, redirect_stderr
+from urllib.parse import quote
+from os import path
+from struct import Struct
+import argparse
+import errno
+import json
+import io
+import os
+import stat
+import sys
+
+
+# kind (o - stdout, e - stderr, s - exit status), length
+frame_header = Struct('>cI')
+
+
+class FrameWriter(io.RawIOBase):
+    def __init__(self, wfile, kind):
+        super().__init__()
+        self.wfile, self.kind = (wfile, kind)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            frame = frame_header.pack(self.kind, len(data)) + bytes(data)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+        return len(data)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers["Content-Length"])).decode())
+        cwd = os.getcwd()
+        try:
+            os.chdir(request["cwd"])
+        except OSError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            self.execute(request["cmd"])
+        finally:
+            os.chdir(cwd)
+
+    def execute(self, cmdl):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        out, err = [io.TextIOWrapper(io.BufferedWriter(
+            FrameWriter(self.wfile, kind)), "utf-8", "replace")
+            for kind in (b'o', b'e')]
+        with redirect_stdout(out), redirect_stderr(err):
+            ok = self.server.fat.execute(cmdl)
+            out.flush()
+            err.flush()
+        FrameWriter(self.wfile, b's').write(bytes([not ok]))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *_):
+        pass
+
+
+def serve(fat, socket_fn):
+    if path.lexists(socket_fn):
+        if not stat.S_ISSOCK(os.lstat(socket_fn).st_mode):
+            raise FileExistsError(errno.EEXIST, "Not a socket", socket_fn)
+        os.unlink(socket_fn)
+    umask = os.umask(0o177)
+    try:
+        server = UnixStreamServer(socket_fn, Handler)
+    finally:
+        os.umask(umask)
+    server.fat = fat
+    try:
+        while fat.is_act:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(socket_fn)
+
+
+def request(socket_fn, cmdl):
+    import requests_unixsocket
+    url = "http+unix://{}/".format(quote(path.abspath(socket_fn), safe=""))
+    data = json.dumps({"cmd": cmdl, "cwd": os.getcwd()})
+    with requests_unixsocket.Session() as session:
+        response = session.post(url, data=data, stream=True)
+        response.raise_for_status()
+        return write_frames(response.iter_content(None))
+
+
+def write_frames(chunks):
+    status, buf = (1, b'')
+    streams = {b'o': sys.stdout.buffer, b'e': sys.stderr.buffer}
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= frame_header.size:
+            kind, length = frame_header.unpack_from(buf)
+            end = frame_header.size + length
+            if len(buf) < end:
+                break
+            data, buf = (buf[frame_header.size:end], buf[end:])
+            if kind == b's':
+                status = data[0]
+            else:
+                streams[kind].write(data)
+                streams[kind].flush()
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Send a command to fat32.py --serve")
+    parser.add_argument('socket', type=str, help="server socket")
+    parser.add_argument('cmd', type=str, nargs=argparse.REMAINDER,
+                        help='cmd for exec')
+    args = parser.parse_args()
+    try:
+        status = request(args.socket, args.cmd)
+    except Exception as e:
+        sys.exit(e)
+    except KeyboardInterrupt:
+        print()
+        status = 1
+    sys.exit(status)
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from functools import wraps
+from time import perf_counter
+from types import GeneratorType
+from threading import Lock
+import json
+
+
+class Stats:
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.calls, self.times = (defaultdict(int), defaultdict(float))
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.calls[name] += 1
+            self.times[name] += seconds
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    self.record(name, perf_counter()-start)
+                if isinstance(result, GeneratorType):
+                    return self.iterate(name, result)
+                return result
+            return wrapper
+        return decorator
+
+    def iterate(self, name, gen):
+        while True:
+            start = perf_counter()
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                elapsed = perf_counter()-start
+                with self.lock:
+                    self.times[name] += elapsed
+            self.add(name + ".bytes", len(item))
+            yield item
+
+    def report(self):
+        with self.lock:
+            timers = {k: {"calls": self.calls[k], "seconds": self.times[k]}
+                      for k in sorted(self.calls)}
+            return {"counters": dict(sorted(self.counters.items())),
+                    "timers": timers}
+
+    def lines(self):
+        report = self.report()
+        for k, v in report["counters"].items():
+            yield "{:<32}{:>14}".format(k, v)
+        for k, v in report["timers"].items():
+            yield "{:<32}{:>14}{:>14.6f}s".format(k, v["calls"], v["seconds"])
+
+    def dump(self, fn):
+        with open(fn, 'w') as fo:
+            json.dump(self.report(), fo, indent=2)
+            fo.write("\n")
+
+
+stats = Stats()